@@ -1,137 +1,596 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException # This is used to create the API and handle file uploads
-from pydantic import BaseModel # This is used to create the data model for the player score
-import motor.motor_asyncio # This is used to connect to MongoDB Atlas
-import base64 # This is used to encode the file content to base64
+from fastapi import FastAPI, File, UploadFile, HTTPException, Header # This is used to create the API and handle file uploads
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse # This is used to send JSON (with orjson) and files back to the client
+from pydantic import BaseModel, Field # This is used to create the data model for the player score
+from typing import Optional # This is used for fields that don't have to be sent
+from pymongo import AsyncMongoClient # This is used to connect to MongoDB Atlas
+from gridfs import AsyncGridFSBucket # This is used to store sprite and audio files in GridFS
+# This is used to decode files that were stored in base64 before GridFS was used
+# pybase64 is a SIMD version of base64, the built-in base64 module is used if it can't be installed
+try:
+    import pybase64 as base64_codec
+except ImportError:
+    import base64 as base64_codec
+from gridfs.errors import NoFile # This is raised by GridFS when a file ID does not exist
 from bson import ObjectId # This is used to convert the ID from the database to a string
+from pymongo.errors import BulkWriteError, PyMongoError # These are errors raised by the MongoDB driver
 from dotenv import load_dotenv
+import asyncio # This is used to run the score batcher in the background
+from contextlib import asynccontextmanager # This is used to run code when the app starts and stops
+from collections import OrderedDict # This is used to keep the file cache in order of use
+from datetime import datetime, timezone # This is used for upload dates and to turn them into ETags
+from concurrent.futures import ThreadPoolExecutor # This is used to decode base64 outside of the event loop
+import logging # This is used to report writes that failed in the background
 import os
+import re # This is used to check that IDs are valid before they are used
+from urllib.parse import quote # This is used to put the filename in the Content-Disposition header
+import time # This is used to expire old entries in the file cache
+import zlib # This is used to make a checksum of the file details for the ETag
 
-app = FastAPI() # This creates the FastAPI app
+# This runs when the app starts and stops
+# When the app starts it creates the indexes, and when it shuts down it makes sure queued scores are written to the database
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await create_indexes()
+    yield
+    await score_batcher.stop()
+    decode_pool.shutdown() # This waits for any base64 decoding that is still running
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse) # This creates the FastAPI app, orjson is much faster than the json module
+logger = logging.getLogger(__name__) # This is used to log errors that happen outside of a request
 
 # Load environment variables from .env file
 load_dotenv()
 MONGO_URL = os.getenv("MONGO_URL") # This loads the MongoDB connection string from the environment variables
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URL) # This is the connection string to MongoDB Atlas
+# The connection pool is sized so bursts of uploads don't wait for a free connection
+client = AsyncMongoClient( # This is the connection string to MongoDB Atlas
+    MONGO_URL,
+    maxPoolSize=200, # This is the most connections the app will open at once
+    minPoolSize=10, # This keeps some connections open so requests don't have to wait for a new one
+    maxIdleTimeMS=300_000, # This closes connections that have not been used for 5 minutes
+    waitQueueTimeoutMS=5000, # This gives up after 5 seconds if every connection is busy
+    compressors="zstd,zlib", # This compresses data sent between the app and Atlas, zstd is used if Atlas supports it
+    zlibCompressionLevel=6, # This is how hard zlib compresses if it is used instead of zstd
+)
 db = client["DatabaseEssensials62A"]  # Make sure the DB name matches Atlas exactly
 
+# Sprites and audio are stored in GridFS, which splits each file into raw binary chunks
+# This avoids base64 (which makes files 33% bigger) and the 16 MB limit on a single MongoDB document
+# GridFS only works with acknowledged writes (w=0 raises a ConfigurationError), so the buckets keep the default write concern
+# The file ID is still created by the app before the upload starts, so no extra round trip is needed to get it
+# Each chunk is CHUNK_SIZE, so every read from an upload is one GridFS chunk and files are sent back in 1 MB pieces
+CHUNK_SIZE = 1 << 20 # This is how many bytes (1 MB) are read from an upload at a time
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024 # This is the biggest file (16 MB) that can be uploaded, bigger files get a 413 error
+fs_sprites = AsyncGridFSBucket(db, bucket_name="sprites", chunk_size_bytes=CHUNK_SIZE) # This stores files in sprites.files / sprites.chunks
+fs_audio = AsyncGridFSBucket(db, bucket_name="audio", chunk_size_bytes=CHUNK_SIZE) # This stores files in audio.files / audio.chunks
+BASE64_CHUNK_SIZE = 4 * 256 * 1024 # This is how many base64 characters are decoded at a time (a multiple of 4 so no chunk is cut mid-group)
+# This is a thread per CPU for decoding base64, which keeps decoding off the event loop
+# If pybase64 is installed it releases the GIL, so the threads decode in parallel; the built-in base64 module does not, so they take turns
+decode_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
 # To Prevent SQL injection attacks, we use Pydantic to validate the data
 # Since player_name and score are required fields, we define them in the PlayerScore model 
 # and this helps us prevent SQL injection attacks by validating the data before inserting it into the database
 class PlayerScore(BaseModel): 
     player_name: str
-    score: int
+    score: int = Field(ge=-2**63, lt=2**63) # MongoDB stores whole numbers as 64-bit, so bigger scores get a 422 error
+
+# This helper builds the document stored for a score straight from the model's fields
+# It is quicker than model_dump() for a model this small, because it skips pydantic's serializer
+def score_to_doc(score: PlayerScore):
+    return {"player_name": score.player_name, "score": score.score}
+
+# This model is used to change the details of a sprite or audio file without uploading it again
+# Both fields are optional, only the fields that are sent are changed
+class FileMeta(BaseModel):
+    filename: Optional[str] = None
+    content_type: Optional[str] = None
+
+# ----------------------------- SCORE BATCHING -----------------------------
+
+# This class collects documents in a queue and writes them with insert_many in the background
+# One insert_many for many documents is much faster than one insert_one (and one round trip to Atlas) per request
+# A batch is written once it has batch_size documents or flush_interval seconds have passed
+# Each request waits for its own batch to be written before it responds, so scores that happen at the same time
+# share one insert_many, but a score is never reported as recorded before it is in the database
+# (on Vercel the app can be frozen as soon as a response is sent, so anything still queued could be lost)
+class InsertBatcher:
+    def __init__(self, collection, batch_size=1000, flush_interval=0.01):
+        self.collection = collection # This is the collection the documents are written to
+        self.batch_size = batch_size # This is the most documents written in one insert_many
+        self.flush_interval = flush_interval # This is how long (in seconds) a batch waits for more documents
+        self.queue = asyncio.Queue() # This holds the documents that have not been written yet
+        self.task = None # This is the background task that writes the batches
+        self.pending = {} # This holds the documents that have been queued but not written yet, by ID
+        self.written = {} # This holds a future for each pending document, set to True or False once its batch is written
+
+    # This adds a document to the queue and waits until its batch has been written
+    # It returns True if the document was inserted and False if the insert failed
+    async def insert(self, doc):
+        self.ensure_running()
+        doc["_id"] = ObjectId() # This creates the ID before the document is inserted
+        future = asyncio.get_running_loop().create_future()
+        self.pending[doc["_id"]] = doc
+        self.written[doc["_id"]] = future
+        self.queue.put_nowait(doc)
+        return await asyncio.shield(future) # shield stops a disconnected client from cancelling the future for everyone else
+
+    # This starts the background task on first use, or again if it stopped because of an error
+    def ensure_running(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    # This waits until a queued document has been written (or its batch has failed)
+    # It returns straight away if the document is not queued
+    async def wait_written(self, doc_id):
+        future = self.written.get(doc_id)
+        if future is None:
+            return
+        self.ensure_running()
+        await asyncio.shield(future)
+
+    # This runs in the background and writes the queued documents in batches
+    # A None in the queue tells it to write what it has and stop
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            doc = await self.queue.get() # This waits for the first document of the next batch
+            if doc is None:
+                return
+            batch = [doc]
+            deadline = loop.time() + self.flush_interval # This is when the batch is written even if it is not full
+            while len(batch) < self.batch_size:
+                try:
+                    doc = await asyncio.wait_for(self.queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if doc is None:
+                    await self.write(batch) # This writes the last batch before stopping
+                    return
+                batch.append(doc)
+            await self.write(batch)
+
+    # This writes one batch, ordered=False lets MongoDB insert the rest if one document fails
+    # Any error is logged instead of raised, so one bad batch can't stop the background task
+    # The requests waiting on the batch are told which of their documents were inserted
+    async def write(self, batch):
+        failed = set() # This holds the positions in the batch of the documents that were not inserted
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+            if not failed:
+                failed = set(range(len(batch))) # This happens if the write concern failed, so none can be trusted
+            logger.exception("Failed to insert %d of %d documents into %s", len(failed), len(batch), self.collection.name)
+        except Exception:
+            failed = set(range(len(batch)))
+            logger.exception("Failed to insert %d documents into %s", len(batch), self.collection.name)
+        finally:
+            for index, doc in enumerate(batch):
+                self.pending.pop(doc["_id"], None) # This removes the documents that have been written from pending
+                future = self.written.pop(doc["_id"], None)
+                if future is not None and not future.done():
+                    future.set_result(index not in failed) # This wakes up the request waiting for this document
+
+    # This writes anything still in the queue and stops the background task
+    async def stop(self):
+        if self.task is not None:
+            self.ensure_running() # This makes sure there is a task to write what is left in the queue
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+
+score_batcher = InsertBatcher(db.scores) # This batches the inserts for the player_score route
+
+# ----------------------------- INDEXES -----------------------------
+
+# This creates the indexes used to look up scores by player, highest score first
+# It also creates the GridFS indexes, because uploads write chunks directly and GridFSBucket only creates them on its own writes
+# create_index does nothing if the index already exists, so this is safe to run every time the app starts
+async def create_indexes():
+    try:
+        await db.scores.create_index([("player_name", 1), ("score", -1)]) # This indexes scores by player and score
+        for collection in (db.sprites, db.audio):
+            await collection.chunks.create_index([("files_id", 1), ("n", 1)], unique=True) # This finds the chunks of a file in order
+            await collection.files.create_index([("filename", 1), ("uploadDate", 1)]) # This is the same index GridFS creates
+    except PyMongoError:
+        logger.exception("Failed to create indexes") # This lets the app start even if Atlas can't be reached yet
+
+# ----------------------------- ID VALIDATION -----------------------------
+
+OBJECT_ID_PATTERN = re.compile(r"[0-9a-fA-F]{24}") # This is what a valid MongoDB ID looks like (24 hex characters)
+
+# This helper turns the ID from the URL into an ObjectId
+# A badly formed ID gets a 400 error straight away instead of a 500 error, and no request is sent to the database
+def parse_object_id(value: str):
+    if not OBJECT_ID_PATTERN.fullmatch(value):
+        raise HTTPException(status_code=400, detail="Invalid ID") # This raises an error if the ID is not valid
+    return ObjectId(value)
+
+# ----------------------------- FILE CACHE -----------------------------
+
+# This class keeps the most recently used file details in memory, the least recently used are dropped when it is full
+# Entries expire after ttl seconds so changes made by another instance of the app are picked up
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize # This is the most entries kept in memory
+        self.ttl = ttl # This is how long (in seconds) an entry is kept
+        self.items = OrderedDict() # This keeps the entries in order of use, oldest first
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires < time.monotonic(): # This drops the entry if it is too old
+            del self.items[key]
+            return None
+        self.items.move_to_end(key) # This marks the entry as the most recently used
+        return value
+
+    def set(self, key, value):
+        self.items[key] = (value, time.monotonic() + self.ttl)
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False) # This drops the least recently used entry
+
+    def pop(self, key):
+        self.items.pop(key, None)
+
+file_cache = LRUCache() # This caches file details by (collection name, ID)
+
+# ----------------------------- GRIDFS HELPERS -----------------------------
+
+# This helper rejects an upload that is bigger than MAX_UPLOAD_BYTES before anything is written to the database
+def check_upload_size(file: UploadFile):
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large") # This raises an error if the file is too big
+
+# This helper reads the next CHUNK_SIZE bytes of an upload (less only at the end of the file)
+# GridFS needs every chunk except the last one to be exactly CHUNK_SIZE bytes
+async def read_chunk(file: UploadFile):
+    chunk = await file.read(CHUNK_SIZE)
+    if not chunk or len(chunk) == CHUNK_SIZE:
+        return chunk
+    buffer = bytearray(chunk) # This only happens if a read returns less than was asked for
+    while len(buffer) < CHUNK_SIZE:
+        data = await file.read(CHUNK_SIZE - len(buffer))
+        if not data:
+            break
+        buffer += data
+    return bytes(buffer)
+
+# This helper writes the chunks of an upload straight into <collection>.chunks one at a time
+# Each chunk is inserted as soon as it is read, so only CHUNK_SIZE bytes of the file are held in memory
+# (pymongo's GridIn is not used because it keeps up to 48 MB of chunks in memory before writing them)
+# It returns the new file ID and the length, the file document is written separately
+async def write_chunks(collection, file: UploadFile):
+    check_upload_size(file)
+    file_id = ObjectId() # This creates the ID before the upload starts
+    length = 0 # This counts the bytes read, in case the size of the upload was not known
+    n = 0 # This is the number of the next chunk
+    try:
+        while chunk := await read_chunk(file): # This reads the next chunk of the upload
+            length += len(chunk)
+            if length > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="File too large") # This stops the upload, the chunks are removed below
+            await collection.chunks.insert_one({"files_id": file_id, "n": n, "data": chunk}) # This writes the chunk to GridFS
+            n += 1
+    except BaseException:
+        await collection.chunks.delete_many({"files_id": file_id}) # This removes any chunks already written if the upload fails
+        raise
+    return file_id, length
+
+# This helper makes the GridFS file document for an upload, in the same format GridFSBucket uses
+def make_file_doc(file_id: ObjectId, file: UploadFile, length: int):
+    return {
+        "_id": file_id,
+        "length": length,
+        "chunkSize": CHUNK_SIZE,
+        "uploadDate": datetime.now(timezone.utc),
+        "filename": file.filename,
+        "metadata": {"content_type": file.content_type}, # This keeps the content type next to the file
+    }
+
+# This helper streams an uploaded file into GridFS one chunk at a time
+# The file document is written last, so the file can't be read until all of its chunks are stored
+async def stream_to_gridfs(collection, file: UploadFile):
+    file_id, length = await write_chunks(collection, file)
+    await collection.files.insert_one(make_file_doc(file_id, file, length)) # This writes the file document
+    return file_id
+
+# This helper decodes a base64 string one chunk at a time
+# Only one decoded chunk is held in memory instead of the whole file
+# Decoding runs in decode_pool so other requests are not blocked while a big file is decoded
+async def decode_base64_chunks(encoded: str):
+    loop = asyncio.get_running_loop()
+    for start in range(0, len(encoded), BASE64_CHUNK_SIZE):
+        chunk = encoded[start:start + BASE64_CHUNK_SIZE]
+        yield await loop.run_in_executor(decode_pool, base64_codec.b64decode, chunk) # This decodes the next chunk
+
+# This helper reads a GridFS file one chunk at a time so it can be streamed to the client
+# Looping over the file directly would split it on newlines, which makes no sense for images and audio
+# The file is closed at the end, or when the client disconnects early, so its cursor is not left open on the server
+async def iter_gridfs_chunks(grid_out):
+    try:
+        while chunk := await grid_out.readchunk(): # This reads the next chunk from the database
+            yield chunk
+    finally:
+        await grid_out.close()
+
+# This helper makes the ETag for a file, which tells the browser which version of the file it has
+# GridFS files get a new upload date when they are replaced, so the ETag changes with the content
+# The filename and content type are hashed into it too, so renaming a file (PATCH) also changes the ETag
+# Otherwise the browser would get a 304 and keep using the old Content-Type and Content-Disposition
+def make_etag(oid: ObjectId, upload_date=None, filename=None, content_type=None):
+    details = zlib.crc32(f"{filename}\0{content_type}".encode()) # This is a short checksum of the filename and type
+    if upload_date is None:
+        return f'"{oid}-{details:08x}"'
+    timestamp = int(upload_date.replace(tzinfo=timezone.utc).timestamp() * 1000) # MongoDB dates are in UTC
+    return f'"{oid}-{timestamp}-{details:08x}"'
+
+# This helper makes the headers sent with a file: the ETag, and the filename so the browser can save it with the right name
+# filename* is used because it allows any characters in the filename (HTTP headers only allow plain ASCII otherwise)
+def file_headers(etag: str, filename: str = None):
+    headers = {"ETag": etag, "Cache-Control": "no-cache"} # no-cache makes the browser check the ETag before using its copy
+    if filename:
+        headers["Content-Disposition"] = f"inline; filename*=UTF-8''{quote(filename, safe='')}"
+    return headers
+
+# This helper checks if the ETag sent by the browser (If-None-Match) matches the current version of the file
+def etag_matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+# This helper loads the details of a file (name, type, size) without reading its content
+# GridFS keeps these in the .files collection, and the projection leaves out the content of files stored before GridFS was used
+# The details are cached, so asking for the same file again does not need a round trip to Atlas
+async def load_file_info(collection, oid: ObjectId):
+    key = (collection.name, oid)
+    info = file_cache.get(key)
+    if info is not None:
+        return info
+    file_doc = await collection.files.find_one({"_id": oid}) # This reads the GridFS file document, which has no content
+    if file_doc:
+        info = {
+            "id": str(oid),
+            "filename": file_doc.get("filename"),
+            "content_type": (file_doc.get("metadata") or {}).get("content_type"),
+            "length": file_doc["length"],
+            "upload_date": file_doc["uploadDate"],
+        }
+    else:
+        legacy_doc = await collection.find_one({"_id": oid}, projection={"content_base64": 0}) # This leaves out the base64 content
+        if not legacy_doc:
+            return None
+        info = {
+            "id": str(oid),
+            "filename": legacy_doc.get("filename"),
+            "content_type": legacy_doc.get("content_type"),
+        }
+    file_cache.set(key, info)
+    return info
+
+# This helper returns the details of a file, or raises a 404 if it doesn't exist
+async def get_file_meta(collection, file_id: str, not_found: str):
+    info = await load_file_info(collection, parse_object_id(file_id))
+    if info is None:
+        raise HTTPException(status_code=404, detail=not_found) # This raises an error if the file is not found
+    return info
+
+# This helper streams a file from GridFS back to the client
+# Files uploaded before GridFS was used are still read from the old collection and sent as raw bytes too
+# If the browser already has the current version (its If-None-Match matches the ETag) a 304 is sent with no content
+async def stream_from_gridfs(bucket, legacy_collection, file_id: str, not_found: str, if_none_match: str = None):
+    oid = parse_object_id(file_id)
+    if if_none_match:
+        info = await load_file_info(legacy_collection, oid) # This is usually cached, so no round trip is needed
+        if info is not None:
+            etag = make_etag(oid, info.get("upload_date"), info["filename"], info["content_type"])
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers=file_headers(etag)) # This tells the browser to use its copy
+    try:
+        grid_out = await bucket.open_download_stream(oid) # This opens the file in GridFS
+    except NoFile:
+        legacy_doc = await legacy_collection.find_one({"_id": oid}) # This checks the old collection
+        if not legacy_doc:
+            raise HTTPException(status_code=404, detail=not_found) # This raises an error if the file is not found
+        etag = make_etag(oid, None, legacy_doc.get("filename"), legacy_doc.get("content_type"))
+        headers = file_headers(etag, legacy_doc.get("filename"))
+        content = decode_base64_chunks(legacy_doc["content_base64"]) # This turns the stored base64 back into bytes
+        return StreamingResponse(content, media_type=legacy_doc.get("content_type"), headers=headers) # This sends the bytes chunk by chunk
+    media_type = (grid_out.metadata or {}).get("content_type") # This gets the content type saved on upload
+    headers = file_headers(make_etag(oid, grid_out.upload_date, grid_out.filename, media_type), grid_out.filename)
+    return StreamingResponse(iter_gridfs_chunks(grid_out), media_type=media_type, headers=headers) # This sends the file chunk by chunk
+
+# This helper replaces the content of a file in GridFS while keeping its ID
+# Files uploaded before GridFS was used are moved into GridFS
+# The new chunks are uploaded under a temporary ID first, so if the upload fails the old file is still there
+# Then one transaction deletes the old file, moves the new chunks over to the old ID and writes the file document
+# Other requests see either the old file or the new one, never a mix, and two PUTs at once can't corrupt the file
+# (MongoDB retries the transaction if another request changed the same file at the same time)
+async def replace_in_gridfs(legacy_collection, file_id: str, file: UploadFile):
+    oid = parse_object_id(file_id)
+    files, chunks = legacy_collection.files, legacy_collection.chunks # GridFS uses the same name as the old collection
+    in_gridfs = await files.find_one({"_id": oid}, projection={"_id": 1}) is not None # This checks if the file is in GridFS
+    if not in_gridfs and await legacy_collection.find_one({"_id": oid}, projection={"_id": 1}) is None:
+        return False # The file was not found in the database, so nothing is uploaded
+    file_cache.pop((legacy_collection.name, oid)) # This removes the old details from the cache
+    tmp_id, length = await write_chunks(legacy_collection, file) # This uploads the new chunks under a temporary ID
+    chunk_count = -(-length // CHUNK_SIZE) # This is how many chunks write_chunks stored (length / CHUNK_SIZE rounded up)
+
+    async def swap(session):
+        delete_result = await files.delete_one({"_id": oid}, session=session) # This removes the old file document
+        if delete_result.deleted_count:
+            await chunks.delete_many({"files_id": oid}, session=session) # This removes the old chunks
+        else:
+            delete_result = await legacy_collection.delete_one({"_id": oid}, session=session) # This removes the old document instead
+            if delete_result.deleted_count == 0:
+                return False # The file was deleted by another request in the meantime
+        move_result = await chunks.update_many({"files_id": tmp_id}, {"$set": {"files_id": oid}}, session=session) # This moves the new chunks to the old ID
+        if move_result.matched_count != chunk_count:
+            raise RuntimeError(f"Expected {chunk_count} chunks for {tmp_id}, found {move_result.matched_count}") # This cancels the transaction
+        await files.insert_one(make_file_doc(oid, file, length), session=session) # This stores the file document under the old ID
+        return True
+
+    try:
+        async with client.start_session() as session:
+            found = await session.with_transaction(swap)
+    except BaseException:
+        await chunks.delete_many({"files_id": tmp_id}) # This removes the new chunks if the transaction failed
+        raise
+    if not found:
+        await chunks.delete_many({"files_id": tmp_id}) # This removes the new chunks because there is no file to replace
+    file_cache.pop((legacy_collection.name, oid)) # This removes details another request may have cached during the upload
+    return found
+
+# This helper changes the details of a file (name and type) without touching its content
+# Only the small file document is updated, the chunks (or the base64 content of older files) are not sent again
+async def update_file_meta(collection, file_id: str, meta: FileMeta):
+    oid = parse_object_id(file_id)
+    changes = meta.model_dump(exclude_none=True) # This keeps only the fields that were sent
+    if not changes:
+        raise HTTPException(status_code=400, detail="Nothing to update") # This raises an error if no fields were sent
+    file_cache.pop((collection.name, oid)) # This removes the old details from the cache
+    gridfs_changes = {} # GridFS keeps the content type inside metadata
+    if "filename" in changes:
+        gridfs_changes["filename"] = changes["filename"]
+    if "content_type" in changes:
+        gridfs_changes["metadata.content_type"] = changes["content_type"]
+    update_result = await collection.files.update_one({"_id": oid}, {"$set": gridfs_changes}) # This updates the GridFS file document
+    if update_result.matched_count == 0:
+        update_result = await collection.update_one({"_id": oid}, {"$set": changes}) # This updates the old document instead
+    file_cache.pop((collection.name, oid)) # This removes details another request may have cached during the update
+    return update_result.matched_count > 0
+
+# This helper deletes a file from GridFS, or from the old collection if it was uploaded before GridFS was used
+async def delete_from_gridfs(bucket, legacy_collection, file_id: str):
+    oid = parse_object_id(file_id)
+    file_cache.pop((legacy_collection.name, oid)) # This removes the details from the cache
+    try:
+        await bucket.delete(oid) # This deletes the file and its chunks
+        deleted = True
+    except NoFile:
+        delete_result = await legacy_collection.delete_one({"_id": oid}) # This deletes the old document instead
+        deleted = delete_result.deleted_count > 0
+    file_cache.pop((legacy_collection.name, oid)) # This removes details another request may have cached during the delete
+    return deleted
 
 # ----------------------------- UPLOAD ROUTES -----------------------------
 
 # This route is used to upload one or more sprite files
-# Accepts multiple image files via form-data, encodes them in base64, and stores them in MongoDB
+# Accepts an image file via form-data and streams it into GridFS
 @app.post("/upload_sprite")
 async def upload_sprite(file: UploadFile = File(...)): # This is used to upload the sprite file
-    content = await file.read()
-    encoded = base64.b64encode(content).decode("utf-8") # This encodes the file content to base64
-    sprite_doc = { # This is the document that will be stored in the database
-        "filename": file.filename,
-        "content_base64": encoded,
-        "content_type": file.content_type
-    }
-    result = await db.sprites.insert_one(sprite_doc) # This inserts the document into the database
-    return {"message": "Sprite uploaded", "id": str(result.inserted_id)}# This returns the ID of the inserted document
+    file_id = await stream_to_gridfs(db.sprites, file) # This streams the file into GridFS
+    return {"message": "Sprite uploaded", "id": str(file_id)}# This returns the ID of the inserted document
 
 # This route is used to upload one or more audio files
-# Accepts multiple audio files via form-data, encodes them in base64, and stores them in MongoDB
+# Accepts an audio file via form-data and streams it into GridFS
 @app.post("/upload_audio")
 async def upload_audio(file: UploadFile = File(...)): # This is used to upload the audio file
-    content = await file.read()
-    encoded = base64.b64encode(content).decode("utf-8") # This encodes the file content to base64
-    audio_doc = { # This is the document that will be stored in the database
-        "filename": file.filename,
-        "content_base64": encoded,
-        "content_type": file.content_type
-    }
-    result = await db.audio.insert_one(audio_doc) # This inserts the document into the database
-    return {"message": "Audio uploaded", "id": str(result.inserted_id)} # This returns the ID of the inserted document
+    file_id = await stream_to_gridfs(db.audio, file) # This streams the file into GridFS
+    return {"message": "Audio uploaded", "id": str(file_id)} # This returns the ID of the inserted document
 
 # This route is used to upload a player score
-# Accepts a JSON object with player name and score, and stores it in MongoDB
+# Accepts a JSON object with player name and score, and stores it in MongoDB together with any scores sent at the same time
 @app.post("/player_score")
 async def add_score(score: PlayerScore): # This is used to upload the player score
-    result = await db.scores.insert_one(score.dict()) # This inserts the document into the database
-    return {"message": "Score recorded", "id": str(result.inserted_id)} # This returns the ID of the inserted document
+    score_doc = score_to_doc(score)
+    inserted = await score_batcher.insert(score_doc) # This inserts the document into the database in the next batch
+    if not inserted:
+        raise HTTPException(status_code=500, detail="Score could not be recorded") # This raises an error if the insert failed
+    return {"message": "Score recorded", "id": str(score_doc["_id"])} # This returns the ID of the inserted document
 
 # ----------------------------- RETRIEVAL ROUTES -----------------------------
 
+# This route is used to retrieve the details of a sprite (name, type, size) without its content
+@app.get("/get_sprite_meta/{sprite_id}")
+async def get_sprite_meta(sprite_id: str): # This is used to retrieve the sprite details by its ID
+    return await get_file_meta(db.sprites, sprite_id, "Sprite not found") # This returns the sprite details
+
 # This route is used to retrieve a sprite by its ID
-# It accepts the sprite ID as a path parameter and returns the sprite document from MongoDB
+# It accepts the sprite ID as a path parameter and streams the sprite file from GridFS
 @app.get("/get_sprite/{sprite_id}")
-async def get_sprite(sprite_id: str): # This is used to retrieve the sprite by its ID
-    sprite = await db.sprites.find_one({"_id": ObjectId(sprite_id)}) # This retrieves the sprite document from the database
-    if not sprite:
-        raise HTTPException(status_code=404, detail="Sprite not found") # This raises an error if the sprite is not found
-    return sprite # This returns the sprite document
+@app.get("/get_sprite_content/{sprite_id}")
+async def get_sprite(sprite_id: str, if_none_match: str = Header(None)): # This is used to retrieve the sprite by its ID
+    return await stream_from_gridfs(fs_sprites, db.sprites, sprite_id, "Sprite not found", if_none_match) # This returns the sprite file
+
+# This route is used to retrieve the details of an audio file (name, type, size) without its content
+@app.get("/get_audio_meta/{audio_id}")
+async def get_audio_meta(audio_id: str): # This is used to retrieve the audio details by its ID
+    return await get_file_meta(db.audio, audio_id, "Audio not found") # This returns the audio details
 
 # This route is used to retrieve an audio file by its ID
-# It accepts the audio ID as a path parameter and returns the audio document from MongoDB
+# It accepts the audio ID as a path parameter and streams the audio file from GridFS
 @app.get("/get_audio/{audio_id}")
-async def get_audio(audio_id: str): # This is used to retrieve the audio by its ID
-    audio = await db.audio.find_one({"_id": ObjectId(audio_id)}) # This retrieves the audio document from the database
-    if not audio:
-        raise HTTPException(status_code=404, detail="Audio not found") # This raises an error if the audio is not found
-    return audio # This returns the audio document
+@app.get("/get_audio_content/{audio_id}")
+async def get_audio(audio_id: str, if_none_match: str = Header(None)): # This is used to retrieve the audio by its ID
+    return await stream_from_gridfs(fs_audio, db.audio, audio_id, "Audio not found", if_none_match) # This returns the audio file
 
 # This route is used to retrieve a player score by its ID
 # It accepts the score ID as a path parameter and returns the score document from MongoDB
+# A score whose POST is still waiting for its batch to be written is returned from the batcher
 @app.get("/get_score/{score_id}")
 async def get_score(score_id: str): # This is used to retrieve the score by its ID
-    score = await db.scores.find_one({"_id": ObjectId(score_id)}) # This retrieves the score document from the database
+    oid = parse_object_id(score_id)
+    if oid in score_batcher.pending:
+        score = dict(score_batcher.pending[oid]) # This returns a score that was recorded but is still waiting to be written
+    else:
+        score = await db.scores.find_one({"_id": oid}) # This retrieves the score document from the database
     if not score:
         raise HTTPException(status_code=404, detail="Score not found") # This raises an error if the score is not found
+    score["_id"] = str(score["_id"]) # This converts the ID so it can be returned as JSON
     return score # This returns the score document
 
 # ----------------------------- UPDATE ROUTES -----------------------------
 
 # This route is used to update a sprite by its ID
-# It accepts the sprite ID as a path parameter and the new file as form-data
+# It accepts the sprite ID as a path parameter and the new file as form-data, which replaces the file in GridFS
 @app.put("/update_sprite/{sprite_id}")
 async def update_sprite(sprite_id: str, file: UploadFile = File(...)): # This is used to update the sprite file
-    content = await file.read() # This reads the content of the file
-    encoded = base64.b64encode(content).decode("utf-8") # This encodes the file content to base64
-    update_result = await db.sprites.update_one(  # This updates the sprite document in the database
-        {"_id": ObjectId(sprite_id)},
-        {"$set": {
-            "filename": file.filename,
-            "content_base64": encoded,
-            "content_type": file.content_type
-        }}
-    )
-    if update_result.matched_count == 0: # This checks if the sprite was found in the database
+    found = await replace_in_gridfs(db.sprites, sprite_id, file) # This replaces the sprite file in GridFS
+    if not found: # This checks if the sprite was found in the database
         raise HTTPException(status_code=404, detail="Sprite not found") # This raises an error if the sprite is not found
     return {"message": "Sprite updated"} # This returns a message indicating that the sprite was updated
 
 # This route is used to update an audio file by its ID
-# It accepts the audio ID as a path parameter and the new file as form-data
+# It accepts the audio ID as a path parameter and the new file as form-data, which replaces the file in GridFS
 @app.put("/update_audio/{audio_id}") 
 async def update_audio(audio_id: str, file: UploadFile = File(...)): # This is used to update the audio file
-    content = await file.read() # This reads the content of the file
-    encoded = base64.b64encode(content).decode("utf-8") # This encodes the file content to base64
-    update_result = await db.audio.update_one(   # This updates the audio document in the database
-        {"_id": ObjectId(audio_id)}, 
-        {"$set": {
-            "filename": file.filename,
-            "content_base64": encoded,
-            "content_type": file.content_type
-        }}
-    )
-    if update_result.matched_count == 0: # This checks if the audio was found in the database
+    found = await replace_in_gridfs(db.audio, audio_id, file) # This replaces the audio file in GridFS
+    if not found: # This checks if the audio was found in the database
         raise HTTPException(status_code=404, detail="Audio not found") # This raises an error if the audio is not found
     return {"message": "Audio updated"} # This returns a message indicating that the audio was updated
 
+# This route is used to change the name or type of a sprite without uploading the file again
+# It accepts the sprite ID as a path parameter and the new details as JSON
+@app.patch("/update_sprite_meta/{sprite_id}")
+async def update_sprite_meta(sprite_id: str, meta: FileMeta): # This is used to update the sprite details
+    found = await update_file_meta(db.sprites, sprite_id, meta) # This updates the sprite details in the database
+    if not found: # This checks if the sprite was found in the database
+        raise HTTPException(status_code=404, detail="Sprite not found") # This raises an error if the sprite is not found
+    return {"message": "Sprite details updated"} # This returns a message indicating that the sprite was updated
+
+# This route is used to change the name or type of an audio file without uploading the file again
+# It accepts the audio ID as a path parameter and the new details as JSON
+@app.patch("/update_audio_meta/{audio_id}")
+async def update_audio_meta(audio_id: str, meta: FileMeta): # This is used to update the audio details
+    found = await update_file_meta(db.audio, audio_id, meta) # This updates the audio details in the database
+    if not found: # This checks if the audio was found in the database
+        raise HTTPException(status_code=404, detail="Audio not found") # This raises an error if the audio is not found
+    return {"message": "Audio details updated"} # This returns a message indicating that the audio was updated
+
 # This route is used to update a player score by its ID
 # It accepts the score ID as a path parameter and the new score as JSON
 @app.put("/update_score/{score_id}") 
 async def update_score(score_id: str, updated_score: PlayerScore): # This is used to update the player score
+    oid = parse_object_id(score_id)
+    await score_batcher.wait_written(oid) # This waits for a score that was just recorded to be written first
     update_result = await db.scores.update_one( # This updates the score document in the database
-        {"_id": ObjectId(score_id)},
-        {"$set": updated_score.dict()}
+        {"_id": oid},
+        {"$set": score_to_doc(updated_score)}
     )
     if update_result.matched_count == 0: # This checks if the score was found in the database
         raise HTTPException(status_code=404, detail="Score not found") # This raises an error if the score is not found
@@ -140,20 +599,20 @@ async def update_score(score_id: str, updated_score: PlayerScore): # This is use
 # ----------------------------- DELETE ROUTES -----------------------------
 
 # This route is used to delete a sprite by its ID
-# It accepts the sprite ID as a path parameter and deletes the sprite document from MongoDB
+# It accepts the sprite ID as a path parameter and deletes the sprite file from GridFS
 @app.delete("/delete_sprite/{sprite_id}")
 async def delete_sprite(sprite_id: str): # This is used to delete the sprite by its ID
-    delete_result = await db.sprites.delete_one({"_id": ObjectId(sprite_id)}) # This deletes the sprite document from the database
-    if delete_result.deleted_count == 0: # This checks if the sprite was found in the database
+    deleted = await delete_from_gridfs(fs_sprites, db.sprites, sprite_id) # This deletes the sprite file from the database
+    if not deleted: # This checks if the sprite was found in the database
         raise HTTPException(status_code=404, detail="Sprite not found") # This raises an error if the sprite is not found
     return {"message": "Sprite deleted"} # This returns a message indicating that the sprite was deleted
 
 # This route is used to delete an audio file by its ID
-# It accepts the audio ID as a path parameter and deletes the audio document from MongoDB
+# It accepts the audio ID as a path parameter and deletes the audio file from GridFS
 @app.delete("/delete_audio/{audio_id}") # This is used to delete the audio by its ID
 async def delete_audio(audio_id: str): # This is used to delete the audio file
-    delete_result = await db.audio.delete_one({"_id": ObjectId(audio_id)}) # This deletes the audio document from the database
-    if delete_result.deleted_count == 0: # This checks if the audio was found in the database
+    deleted = await delete_from_gridfs(fs_audio, db.audio, audio_id) # This deletes the audio file from the database
+    if not deleted: # This checks if the audio was found in the database
         raise HTTPException(status_code=404, detail="Audio not found") # This raises an error if the audio is not found
     return {"message": "Audio deleted"} # This returns a message indicating that the audio was deleted
 
@@ -162,7 +621,9 @@ async def delete_audio(audio_id: str): # This is used to delete the audio file
 # It accepts the score ID as a path parameter and deletes the score document from MongoDB
 @app.delete("/delete_score/{score_id}") # This is used to delete the score by its ID
 async def delete_score(score_id: str): # This is used to delete the player score
-    delete_result = await db.scores.delete_one({"_id": ObjectId(score_id)}) # This deletes the score document from the database
+    oid = parse_object_id(score_id)
+    await score_batcher.wait_written(oid) # This waits for a score that was just recorded to be written first, so it can't come back later
+    delete_result = await db.scores.delete_one({"_id": oid}) # This deletes the score document from the database
     if delete_result.deleted_count == 0: # This checks if the score was found in the database
         raise HTTPException(status_code=404, detail="Score not found") # This raises an error if the score is not found
     return {"message": "Score deleted"} # This returns a message indicating that the score was deleted
\ No newline at end of file